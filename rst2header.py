@@ -1,9 +1,84 @@
+import argparse
+import bisect
+import contextlib
+import cProfile
+import hashlib
+import json
+import marshal
+import multiprocessing
 import os
 import re
 import sys
+import tempfile
+import time
+from collections import namedtuple
 from io import StringIO
 
 reserved_str = '--'
+generator_version = '1.4'
+parser_version = 2
+manifest_name = '.rst2header.json'
+instances_name = 'instances.json'
+hex_zeros_pattern = re.compile(r'\b0x0*([0-9A-F]+)\b')
+underline_pattern = re.compile(r'^\^+$')
+# the widths a register title can give, without one a register is 32-bit
+reg_widths = (8, 16, 32, 64)
+BitLayout = namedtuple('BitLayout', 'fields mask')
+
+
+def get_digest(data):
+    return hashlib.sha1(data).hexdigest()
+
+
+def update_file(file, content):
+    """Write content to file unless it already holds exactly that content.
+
+    The content is written to a temporary file which is then renamed over
+    file, so readers never see a partly written file. Returns True if the
+    file was written.
+    """
+    data = content.encode() if isinstance(content, str) else content
+    try:
+        with open(file, 'rb') as rf:
+            if rf.read() == data:
+                return False
+        mode = os.stat(file).st_mode & 0o777
+    except (IOError, OSError):
+        umask = os.umask(0)
+        os.umask(umask)
+        mode = 0o666 & ~umask
+    file_dir, file_name = os.path.split(file)
+    fd, temp_file = tempfile.mkstemp(prefix='.{}.'.format(file_name),
+                                     dir=file_dir or '.')
+    try:
+        with os.fdopen(fd, 'wb') as wf:
+            wf.write(data)
+        os.chmod(temp_file, mode)
+        os.replace(temp_file, file)
+    except BaseException:
+        os.remove(temp_file)
+        raise
+    return True
+
+
+class RstError(Exception):
+    """An error found in a register description.
+
+    code names the kind of error for tools, file and line locate it when
+    they are known.
+    """
+
+    def __init__(self, message, code, file=None, line=None):
+        Exception.__init__(self, message, code, file, line)
+        self.message, self.code = message, code
+        self.file, self.line = file, line
+
+    def __str__(self):
+        if self.file and self.line:
+            return '{}: {}> {}'.format(self.file, self.line, self.message)
+        elif self.file:
+            return '{}: {}'.format(self.file, self.message)
+        return self.message
 
 
 class RegField(object):
@@ -11,22 +86,57 @@ class RegField(object):
     rst_bits = '   * - {}:{}\n     - {}\n     - {}\n     - {}\n     - {}\n'
     to_str = ('bits: {}:{}\nname: {}\ndescription: {}\n'
               'access: {}\nreset: {}\ntype: {}\n')
+    __slots__ = ('up', 'down', '_name', '_description', '_rst_des', 'access',
+                 'reset', 'type')
 
     def __init__(self, bit, name, description, access, reset, val_type):
         self.up, self.down = bit
-        self.name, self.description = name, description
-        self.access, self.reset, self.type = access, reset, val_type
+        self._name, self._description = name, description
+        self._rst_des = None
+        # a chip has only a handful of distinct flags and reset values
+        self.access, self.reset = sys.intern(access), sys.intern(reset)
+        self.type = sys.intern(val_type)
 
     def __str__(self):
-        name_des = ('**{}** {}'.format(self.name, self.description)
-                    if self.name != reserved_str else self.description)
-        name_des = re.sub('\n(?!$)', '\n\n       ', name_des)
+        rst_str = StringIO()
+        self.write_rst(rst_str)
+        return rst_str.getvalue()
+
+    def write_rst(self, rst_file):
         if self.up == self.down:
-            return RegField.rst_1bit.format(self.up, name_des, self.access,
-                                            self.reset, self.type)
+            rst_file.write(RegField.rst_1bit.format(
+                self.up, self.rst_des, self.access, self.reset, self.type))
         else:
-            return RegField.rst_bits.format(self.up, self.down, name_des,
-                                            self.access, self.reset, self.type)
+            rst_file.write(RegField.rst_bits.format(
+                self.up, self.down, self.rst_des, self.access, self.reset,
+                self.type))
+
+    @property
+    def name(self):
+        return self._name
+
+    @name.setter
+    def name(self, name):
+        self._name = name
+        self._rst_des = None
+
+    @property
+    def description(self):
+        return self._description
+
+    @description.setter
+    def description(self, description):
+        self._description = description
+        self._rst_des = None
+
+    @property
+    def rst_des(self):
+        """The description cell of the rst table, indented for rendering."""
+        if self._rst_des is None:
+            name_des = ('**{}** {}'.format(self._name, self._description)
+                        if self._name != reserved_str else self._description)
+            self._rst_des = name_des.replace('\n', '\n\n       ')
+        return self._rst_des
 
 
 class Register(object):
@@ -46,88 +156,202 @@ class Register(object):
                              '     - Reset\n'
                              '     - Value\n')
 
-    def __init__(self, name, description, offset):
+    __slots__ = ('name', 'description', 'description_ex', 'offset', 'width',
+                 'description_end', 'is_long_table', '_fields', '_layout')
+
+    def __init__(self, name, description, offset, width=32):
         self.name = name.lower()
         self.description, self.description_ex = description
         self.offset = offset
+        self.width = width
         self.description_end = ''
         self.is_long_table = False
-        if self.description_ex:
-            self.full_des = ('{} ({}, 0x{:04X}_{:04X}) {}'.
-                             format(name.upper(), description[0],
-                                    offset >> 16, offset & 0xffff,
-                                    description[1]))
-        else:
-            self.full_des = ('{} ({}, 0x{:04X}_{:04X})'.
-                             format(name.upper(), description[0],
-                                    offset >> 16, offset & 0xffff))
-        self.reg_fields = []
+        self._fields = []
+        self._layout = None
 
     def __str__(self):
         reg_str = StringIO()
-        reg_str.write('{}\n'.format(self.full_des))
-        reg_str.write('^' * len(self.full_des) + '\n')
-        if self.is_long_table:
-            reg_str.write(Register.long_table_header_str)
-        else:
-            reg_str.write(Register.header_str)
+        self.write_rst(reg_str)
+        return reg_str.getvalue()
+
+    def write_rst(self, rst_file):
+        full_des = self.full_des
+        rst_file.write('{}\n{}\n{}'.format(
+            full_des, '^' * len(full_des),
+            Register.long_table_header_str if self.is_long_table
+            else Register.header_str))
         for reg_field in reversed(self.reg_fields):
-            reg_str.write(str(reg_field))
-        reg_str.write('\n')
+            reg_field.write_rst(rst_file)
+        rst_file.write('\n')
         if self.description_end:
-            reg_str.write('{}'.format(self.description_end.
-                                      replace('\n', '\n\n')))
-            reg_str.write('\n\n')
-        return reg_str.getvalue()
+            rst_file.write('{}\n\n'.format(
+                self.description_end.replace('\n', '\n\n')))
 
-    def set_all_bits(self, reg_fields):
-        for reg_field in reg_fields:
-            self.reg_fields.append(reg_field)
-        self.check_bits()
+    @property
+    def full_des(self):
+        """The register title line, built on demand to keep regs small.
+
+        Only a register which is not 32-bit has its width in the title.
+        """
+        title = ('{} ({}, 0x{:04X}_{:04X}'.
+                 format(self.name.upper(), self.description,
+                        self.offset >> 16, self.offset & 0xffff))
+        if self.width != 32:
+            title += ', {}-bit'.format(self.width)
+        if self.description_ex:
+            return '{}) {}'.format(title, self.description_ex)
+        return title + ')'
+
+    @property
+    def layout(self):
+        """The validated BitLayout, computed once until invalidated."""
+        if self._layout is None:
+            self._layout = self.get_bit_layout()
+        return self._layout
+
+    @property
+    def reg_fields(self):
+        return self.layout.fields
+
+    @property
+    def size(self):
+        """The number of bytes of the register."""
+        return self.width // 8
+
+    def to_tuple(self):
+        """The register as plain tuples, as stored in the parse cache."""
+        return (self.name, self.description, self.description_ex,
+                self.offset, self.width, self.description_end,
+                self.is_long_table,
+                tuple((reg_field.up, reg_field.down, reg_field.name,
+                       reg_field.description, reg_field.access,
+                       reg_field.reset, reg_field.type)
+                      for reg_field in self.reg_fields))
+
+    @classmethod
+    def from_tuple(cls, data):
+        (name, description, description_ex, offset, width, description_end,
+         is_long_table, reg_fields) = data
+        reg = cls(name, (description, description_ex), offset, width)
+        reg.description_end = description_end
+        reg.is_long_table = is_long_table
+        reg.set_all_bits(RegField((up, down), *attrs)
+                         for up, down, *attrs in reg_fields)
+        return reg
+
+    def set_all_bits(self, reg_fields, check=True):
+        self._fields.extend(reg_fields)
+        self.invalidate_layout()
+        if check:
+            self.check_bits()
+
+    def invalidate_layout(self):
+        """Must be called after the bits of a field are changed."""
+        self._layout = None
 
     def check_bits(self):
-        self.reg_fields.sort(key=lambda b: b.down)
-        cmp_down = 0
-        for reg_field in self.reg_fields:
-            if reg_field.down != cmp_down:
+        return self.layout
+
+    def get_bit_layout(self):
+        fields = tuple(sorted(self._fields, key=lambda b: b.down))
+        mask = 0
+        for reg_field in fields:
+            if reg_field.up < reg_field.down:
+                raise RstError('bit conflict or error at {} bit {}:{}'.
+                               format(self.full_des, reg_field.up,
+                                      reg_field.down), 'bit-range')
+            bit_num = reg_field.up - reg_field.down + 1
+            if (reg_field.reset != reserved_str and
+                    int(reg_field.reset, 16) >> bit_num):
+                raise RstError('reset value {} does not fit in bit {}:{} of '
+                               '{}'.format(reg_field.reset, reg_field.up,
+                                           reg_field.down, self.full_des),
+                               'reset')
+            field_mask = (2 << reg_field.up) - (1 << reg_field.down)
+            if mask & field_mask:
                 if reg_field.down == reg_field.up:
-                    raise Exception('bit collide or error at {} bit {}'.
-                                    format(self.full_des, reg_field.up))
+                    raise RstError('bit collide or error at {} bit {}'.
+                                   format(self.full_des, reg_field.up),
+                                   'bit-collide')
                 else:
-                    raise Exception('bit collide or error at {} bit {}:{}'.
-                                    format(self.full_des, reg_field.up,
-                                           reg_field.down))
-            if reg_field.up < reg_field.down:
-                raise Exception('bit conflict or error at {} bit {}:{}'.
-                                format(self.full_des, reg_field.up,
-                                       reg_field.down))
-            cmp_down = reg_field.up + 1
-        if cmp_down != 32:
-            raise Exception('{} is not begin with bit 31'.format(self.full_des))
+                    raise RstError('bit collide or error at {} bit {}:{}'.
+                                   format(self.full_des, reg_field.up,
+                                          reg_field.down), 'bit-collide')
+            mask |= field_mask
+        if mask != (1 << self.width) - 1:
+            missing = ~mask & (mask + 1)
+            if mask >> self.width or not mask & ~(missing - 1):
+                raise RstError('{} is not begin with bit {}'.
+                               format(self.full_des, self.width - 1),
+                               'bit-width')
+            raise RstError('bit collide or error at {} bit {}'.
+                           format(self.full_des, missing.bit_length() - 1),
+                           'bit-gap')
+        return BitLayout(fields, mask)
 
     def get_isp_reg(self):
         self.check_bits()
         return self
 
     def generate_header(self, cut_prefix=''):
-        self.check_bits()
-        name = '_'.join(self.name.split('_')[1:]) if cut_prefix else self.name
         header = StringIO()
+        self.write_header(header, cut_prefix)
+        return header.getvalue()
+
+    def get_member_name(self, cut_prefix=''):
+        return '_'.join(self.name.split('_')[1:]) if cut_prefix else self.name
+
+    def get_reset_value(self):
+        """The reset value of the register, reserved bits are 0."""
+        value = 0
+        for reg_field in self.reg_fields:
+            if reg_field.reset == reserved_str:
+                continue
+            value |= int(reg_field.reset, 16) << reg_field.down
+        return value
+
+    def get_c_value(self, value):
+        """A register value as a C literal of the register width."""
+        if self.width > 32:
+            return '0x{:016X}ULL'.format(value)
+        return '0x{:08X}'.format(value)
+
+    def write_accessors(self, header):
+        """Write the _SHIFT and _MASK macros of the fields and _RESET."""
+        name = self.name.upper()
+        for reg_field in self.reg_fields:
+            if reg_field.name == reserved_str:
+                continue
+            field_name = '{}_{}'.format(name, reg_field.name.upper())
+            header.write('#define {}_SHIFT {}\n'.
+                         format(field_name, reg_field.down))
+            header.write('#define {}_MASK {}\n'.format(
+                field_name, self.get_c_value((2 << reg_field.up) -
+                                             (1 << reg_field.down))))
+        header.write('#define {}_RESET {}\n'.
+                     format(name, self.get_c_value(self.get_reset_value())))
+
+    def write_header(self, header, cut_prefix=''):
+        self.check_bits()
+        name = self.get_member_name(cut_prefix)
         header.write('\tunion {\n')
-        header.write('\t\tuint32_t {};\n'.format(name))
+        # the bit fields have the type of the register, so the struct has
+        # its size and a field can be wider than an int
+        c_type = 'uint{}_t'.format(self.width)
+        header.write('\t\t{} {};\n'.format(c_type, name))
         header.write('\t\tstruct {\n')
         reserved_index = 0
         for reg_field in self.reg_fields:
             bit_num = reg_field.up - reg_field.down + 1
             if reg_field.name == reserved_str:
-                header.write('\t\t\treserved{}:{};\n'.
-                             format(reserved_index, bit_num))
+                header.write('\t\t\t{} reserved{}:{};\n'.
+                             format(c_type, reserved_index, bit_num))
                 reserved_index += 1
             else:
-                header.write('\t\t\t{}:{};\n'.format(reg_field.name, bit_num))
+                header.write('\t\t\t{} {}:{};\n'.
+                             format(c_type, reg_field.name, bit_num))
         header.write('\t\t}} {}_bit;\n'.format(name))
         header.write('\t};\n')
-        return header.getvalue()
 
 
 class Module(object):
@@ -137,25 +361,93 @@ class Module(object):
                  '|K{1cm}|p{10cm}|K{1.2cm}|K{1cm}|K{1cm}|\n\n')
     end_str = '.. tabularcolumns:: |l|l|l|l|l|l|l|l|l|l|\n'
 
-    def __init__(self, name):
+    def __init__(self, name, instances=None):
         self.name = name
         self.regs = []
+        self.offsets = []
+        # [name, base] of every instance of the module, sorted by base
+        self.instances = instances or []
 
     def __str__(self):
         module_str = StringIO()
-        module_str.write(Module.start_str)
-        for reg in self.regs:
-            module_str.write(str(reg))
-        module_str.write(Module.end_str)
+        self.write_rst(module_str)
         return module_str.getvalue()
 
+    def write_rst(self, rst_file):
+        """Render the canonical rst of the module into one file-like object.
+
+        Every register and field writes straight into rst_file, no
+        intermediate string is built for them.
+        """
+        rst_file.write(Module.start_str)
+        for reg in self.regs:
+            reg.write_rst(rst_file)
+        rst_file.write(Module.end_str)
+
     def append_regs(self, regs):
+        regs = list(regs)
+        pre_offset = self.offsets[-1] if self.offsets else None
+        pre_end = self.get_span()[0] + self.get_span()[1]
+        offsets = []
+        for reg in regs:
+            # a register is aligned to its own size, like in a C struct
+            if reg.offset % reg.size or reg.offset < pre_end:
+                raise RstError('reg offset is error at {} to {}'.
+                               format(reg.offset, pre_offset), 'reg-offset')
+            offsets.append(reg.offset)
+            pre_offset = reg.offset
+            pre_end = reg.offset + reg.size
         self.regs.extend(regs)
+        self.offsets.extend(offsets)
+
+    def find_reg(self, offset):
+        i = bisect.bisect_left(self.offsets, offset)
+        if i < len(self.offsets) and self.offsets[i] == offset:
+            return self.regs[i]
+        return None
+
+    def get_span(self):
+        """The (base, size) of the address range covered by the regs."""
+        if not self.offsets:
+            return 0, 0
+        return (self.offsets[0],
+                self.offsets[-1] + self.regs[-1].size - self.offsets[0])
+
+    def get_gaps(self):
+        """Yield (offset, size) of every hole before and between regs."""
+        cmp_offset = 0
+        for reg in self.regs:
+            if reg.offset > cmp_offset:
+                yield cmp_offset, reg.offset - cmp_offset
+            cmp_offset = reg.offset + reg.size
+
+    def to_database(self):
+        """The registers as plain data, indexed by name and by offset.
+
+        by_name and by_offset map to the index of a register in regs, the
+        by_name of a register maps to the index of a field in its fields.
+        """
+        regs, by_name, by_offset = [], {}, {}
         for i, reg in enumerate(self.regs):
-            pre_reg = self.regs[i - 1] if i else None
-            if reg.offset % 4 or (pre_reg and reg.offset < pre_reg.offset):
-                raise Exception('reg offset is error at {} to {}'.
-                                format(reg.offset, pre_reg.offset))
+            fields, field_by_name = [], {}
+            for j, reg_field in enumerate(reg.reg_fields):
+                fields.append({'name': reg_field.name,
+                               'up': reg_field.up, 'down': reg_field.down,
+                               'access': reg_field.access,
+                               'reset': (int(reg_field.reset, 16)
+                                         if reg_field.reset != reserved_str
+                                         else None),
+                               'type': reg_field.type})
+                if reg_field.name != reserved_str:
+                    field_by_name[reg_field.name] = j
+            regs.append({'name': reg.name, 'offset': reg.offset,
+                         'width': reg.width, 'description': reg.description,
+                         'fields': fields, 'by_name': field_by_name})
+            by_name[reg.name] = i
+            by_offset['0x{:08X}'.format(reg.offset)] = i
+        return {'module': self.name, 'version': generator_version,
+                'regs': regs, 'by_name': by_name, 'by_offset': by_offset,
+                'instances': dict(self.instances)}
 
     def get_module_prefix(self):
         prefix = ''
@@ -168,171 +460,386 @@ class Module(object):
                 prefix = reg.name.split('_')[0]
         return prefix
 
-    def generate_user_headers(self, file_handler, cut_prefix=False):
-        file_handler.write('#include <stdint.h>\n\n')
-        for reg in self.regs:
-            file_handler.write('#define {} 0x{:08X}\n'.
-                               format(reg.name.upper(), reg.offset))
-        file_handler.write('\nstruct {}_reg {{\n'.format(self.name))
+    def write_instances(self, header):
+        name = self.name.upper()
+        header.write('\n')
+        for instance, base in self.instances:
+            header.write('#define {}_BASE 0x{:08X}\n'.
+                         format(instance.upper(), base))
+        header.write('#define {}_INSTANCE_NUM {}\n\n'.
+                     format(name, len(self.instances)))
+        header.write('static const uint32_t {}_reg_bases[{}_INSTANCE_NUM] = '
+                     '{{\n'.format(self.name, name))
+        for instance, base in self.instances:
+            header.write('\t{}_BASE,\n'.format(instance.upper()))
+        header.write('};\n')
+
+    def write_headers(self, user_file=None, kernel_file=None,
+                      accessors=False, cut_prefix=None, guard=True):
+        """Render the user and kernel headers in one pass over the regs.
+
+        Each header is written to its file-like object with a single write,
+        either of them may be None to skip it. With accessors the headers
+        also get the field macros of every register and a reset struct, to
+        initialise the whole module with one copy. The kernel header gets a
+        table of reset values only when all regs have the same width, as
+        one array can not have the layout of mixed-width regs. A module with
+        instances gets their base addresses, all of them share its struct.
+        cut_prefix defaults to whether all regs share a prefix, without guard
+        the #ifndef lines around the headers are left out.
+        """
+        name = self.name.upper()
+        begin = ('#ifndef _{}_REG_H\n#define _{}_REG_H\n\n'.format(name, name)
+                 if guard else '')
+        end = '\n#endif /* _{}_REG_H */\n'.format(name) if guard else ''
+        if cut_prefix is None:
+            cut_prefix = True if self.get_module_prefix() else False
+        user_header = StringIO()
+        user_header.write(begin)
+        user_header.write('#include <stdint.h>\n\n')
+        user_struct = StringIO()
+        user_struct.write('\nstruct {}_reg {{\n'.format(self.name))
+        user_reset = StringIO()
+        user_reset.write('\nstatic const struct {}_reg {}_reg_reset = {{\n'.
+                         format(self.name, self.name))
+        kernel_header = StringIO()
+        kernel_header.write(begin)
+        widths = set(reg.width for reg in self.regs) or {32}
+        reset_table = accessors and len(widths) == 1
+        width = max(widths)
+        kernel_reset = StringIO()
+        kernel_reset.write('\nstatic const uint{}_t {}_reg_reset[] = {{\n'.
+                           format(width, self.name))
+        accessor_macros = StringIO()
         cmp_offset = reserved_index = 0
         for reg in self.regs:
+            name = reg.name.upper()
+            kernel_header.write('#define {} 0x{:04X}\n'.
+                                format(name, reg.offset))
+            if accessors:
+                accessor_macros.write('\n')
+                reg.write_accessors(accessor_macros)
+                kernel_reset.write('\t[0x{:04X} / {}] = {}_RESET,\n'.
+                                   format(reg.offset, width // 8, name))
+                user_reset.write('\t.{} = {}_RESET,\n'.
+                                 format(reg.get_member_name(cut_prefix),
+                                        name))
+            if user_file is None:
+                continue
+            user_header.write('#define {} 0x{:08X}\n'.
+                              format(name, reg.offset))
             if reg.offset != cmp_offset:
-                file_handler.write('\tuint32_t reserved{}[{}];\n'.
-                                   format(reserved_index,
-                                          (reg.offset - cmp_offset) // 4))
+                gap = reg.offset - cmp_offset
+                if gap % 4 or cmp_offset % 4:
+                    user_struct.write('\tuint8_t reserved{}[{}];\n'.
+                                      format(reserved_index, gap))
+                else:
+                    user_struct.write('\tuint32_t reserved{}[{}];\n'.
+                                      format(reserved_index, gap // 4))
                 reserved_index += 1
-            cmp_offset = reg.offset + 4
-            file_handler.write(reg.generate_header(cut_prefix))
-        file_handler.write('};\n')
+            cmp_offset = reg.offset + reg.size
+            reg.write_header(user_struct, cut_prefix)
+        instances = StringIO()
+        if self.instances:
+            self.write_instances(instances)
+        if user_file is not None:
+            user_header.write(accessor_macros.getvalue())
+            user_header.write(user_struct.getvalue())
+            user_header.write('};\n')
+            if accessors:
+                user_header.write(user_reset.getvalue())
+                user_header.write('};\n')
+            user_header.write(instances.getvalue())
+            user_header.write(end)
+            user_file.write(user_header.getvalue())
+        if kernel_file is not None:
+            kernel_header.write(accessor_macros.getvalue())
+            if reset_table:
+                kernel_header.write(kernel_reset.getvalue())
+                kernel_header.write('};\n')
+            kernel_header.write(instances.getvalue())
+            kernel_header.write(end)
+            kernel_file.write(kernel_header.getvalue())
+
+    def generate_user_headers(self, file_handler, cut_prefix=False):
+        self.write_headers(user_file=file_handler, cut_prefix=cut_prefix,
+                           guard=False)
 
     def generate_kernel_headers(self, file_handler):
-        for reg in self.regs:
-            file_handler.write('#define {} 0x{:04X}\n'.
-                               format(reg.name.upper(), reg.offset))
+        self.write_headers(kernel_file=file_handler, guard=False)
+
+    def render_headers(self, user_space=True):
+        header = StringIO()
+        if user_space:
+            self.write_headers(user_file=header)
+        else:
+            self.write_headers(kernel_file=header)
+        return header.getvalue()
 
     def generate_headers(self, file, user_space=True):
-        with open(file, 'w') as file_handler:
-            file_handler.write('#ifdef _{}_REG_H\n'.format(self.name.upper()))
-            file_handler.write('#define _{}_REG_H\n\n'.
-                               format(self.name.upper()))
-            if user_space:
-                cut_prefix = True if self.get_module_prefix() else False
-                self.generate_user_headers(file_handler, cut_prefix=cut_prefix)
-            else:
-                self.generate_kernel_headers(file_handler)
-            file_handler.write('\n#endif /* _{}_REG_H */\n'.
-                               format(self.name.upper()))
+        return update_file(file, self.render_headers(user_space))
 
 
 class RstParser(object):
-    name_pattern = re.compile(r'^([A-Z][A-Z0-9_]+) \((.+?), '
-                              r'0x([0-9A-F]{4}_[0-9A-F]{4})\)(?: (.+?))?$')
-    section_pattern = re.compile(r'^(\^+)$')
-    bit_pattern = re.compile(r'^ {3}\* - (\d+)(?::(\d+))?$')
-    reserved_pattern = '     - Reserved'
-    des0_pattern = re.compile(r'^ {5}- \*\*(\S+?)\*\* (.*)$')
-    des1_pattern = re.compile(r'^ {7}(.+)$')
-    access_pattern = re.compile(r'^ {5}- (R/W|R|W1P|W1C|W1P/R|' +
-                                reserved_str + r')$')
-    reset_pattern = re.compile(r'^ {5}- (0x[0-9A-F]+|' + reserved_str +
-                               r')$')
-    type_pattern = re.compile(r'^ {5}- (U|S|' + reserved_str + ')$')
-    space_pattern = re.compile(r'[ \t]+$')
-
-    def __init__(self, rst_file):
+    # every line of the parse area is classified once by this pattern, the
+    # name of the matched alternative is the kind of the line
+    token_pattern = re.compile(
+        r'(?P<bit> {3}\* - (?P<up>\d+)(?::(?P<down>\d+))?$)'
+        r'|(?P<field> {5}- \*\*(?P<field_name>\S+?)\*\* (?P<field_des>.*)$)'
+        r'|(?P<item> {5}- (?P<value>.+)$)'
+        r'|(?P<text> {7}(?P<text_des>.+)$)'
+        r'|(?P<name>(?P<reg_name>[A-Z][A-Z0-9_]+) \((?P<reg_des>.+?), '
+        r'0x(?P<offset>[0-9A-F]{4}_[0-9A-F]{4})(?:, (?P<width>\d+)-bit)?\)'
+        r'(?: (?P<reg_des_ex>.+?))?$)'
+        r'|(?P<section>\^+$)')
+    reserved_value = 'Reserved'
+    access_values = frozenset(('R/W', 'R', 'W1P', 'W1C', 'W1P/R',
+                               reserved_str))
+    type_values = frozenset(('U', 'S', reserved_str))
+    hex_digits = '0123456789ABCDEF'
+    start_lines = Module.start_str.splitlines()
+    end_line = Module.end_str.rstrip('\n')
+    header_lines = Register.header_str.splitlines()
+    long_table_line = Register.long_table_header_str.splitlines()[2]
+
+    def __init__(self, rst_file, lines=None, lazy=False, cache_dir=None,
+                 lint=False):
+        """Parse the registers of rst_file in a single pass.
+
+        The file is read line by line, lines may be given instead when its
+        content is already in memory. With lazy no register is parsed until
+        the parser is iterated, which yields each register once its table
+        and end description are complete. With cache_dir the registers are
+        loaded from there when the same content was parsed before.
+
+        With lint the parser does not stop at the first error. Each error
+        is collected in errors and parsing goes on with the next field or
+        register, only registers without errors are kept.
+        """
         self.file = rst_file
-        self.i = self.end = 0
-        self.start_file_line = 7
-        self.regs = []
-        with open(rst_file, 'r') as rf:
-            self.rst_lines = rf.readlines()
-        self.strip_rst_lines()
-        self.set_parse_area()
-        self.parse_rst_lines()
+        self.lines = lines
+        self.lint = lint
+        self.errors = []
+        self.file_line = 0
+        self.cur_line = self.pre_line = ''
+        self.cur_kind = self.cur_match = None
+        self.at_end = False
+        self.tokens = self.next_token = None
+        if lazy:
+            self.regs = []
+        elif cache_dir is not None:
+            self.regs = self.parse_cached(cache_dir)
+        else:
+            self.regs = list(self)
 
-    def goto_next_line(self):
-        self.i += 1
+    def __iter__(self):
+        self.tokens = self.tokenize()
+        self.cur_line = self.pre_line = ''
+        self.at_end = False
+        self.next_token = next(self.tokens, None)
+        self.goto_next_line()
+        cmp_offset = 0
+        while not self.at_end:
+            reg_line = self.file_line
+            try:
+                reg = self.get_next_reg()
+            except RstError as e:
+                self.report(e)
+                self.skip_to_next_reg()
+                continue
+            if not reg:
+                continue
+            if reg.offset < cmp_offset or reg.offset % reg.size:
+                self.report(RstError('{} offset is not in order or not '
+                                     'aligned\n'.format(reg.full_des),
+                                     'reg-offset', self.file, reg_line))
+                continue
+            cmp_offset = reg.offset + reg.size
+            yield reg
 
-    def goto_next_n_lines(self, n):
-        self.i += n
+    def error(self, code, message):
+        return RstError(message, code, self.file, self.file_line)
 
-    @property
-    def file_line(self):
-        return self.i + self.start_file_line
+    def report(self, error):
+        """Raise error, or only collect it when linting."""
+        if not self.lint:
+            raise error
+        self.errors.append(error)
 
-    @property
-    def cur_line(self):
-        return self.rst_lines[self.i]
+    def is_reg_start(self):
+        try:
+            return bool(self.try_cur_pos_to_reg_attr()[0])
+        except RstError as e:
+            self.report(e)
+            return False
 
-    @property
-    def pre_line(self):
-        return self.rst_lines[self.i - 1]
+    def skip_to_next_reg(self):
+        self.goto_next_line()
+        while not self.at_end and not self.is_reg_start():
+            self.goto_next_line()
 
-    @property
-    def next_line(self):
-        return self.rst_lines[self.i + 1]
+    def skip_to_next_field(self):
+        self.goto_next_line()
+        while (not self.at_end and self.cur_kind != 'bit' and
+               not self.is_reg_start()):
+            self.goto_next_line()
+
+    def parse_cached(self, cache_dir):
+        if self.lines is None:
+            with open(self.file, 'rb') as rf:
+                text = rf.read().decode()
+        else:
+            text = ''.join(self.lines)
+        self.lines = StringIO(text)
+        cache_file = os.path.join(cache_dir, '{}-{}.marshal'.format(
+            get_digest(text.encode()), parser_version))
+        try:
+            with open(cache_file, 'rb') as cf:
+                return [Register.from_tuple(reg) for reg in marshal.load(cf)]
+        except (IOError, OSError, EOFError, ValueError, TypeError):
+            pass
+        regs = list(self)
+        os.makedirs(cache_dir, exist_ok=True)
+        update_file(cache_file,
+                    marshal.dumps(tuple(reg.to_tuple() for reg in regs)))
+        return regs
+
+    def goto_next_line(self):
+        self.pre_line = self.cur_line
+        if self.next_token is None:
+            self.cur_line = ''
+            self.cur_kind = self.cur_match = None
+            self.at_end = True
+            return
+        (self.file_line, self.cur_line, self.cur_kind,
+         self.cur_match) = self.next_token
+        self.next_token = next(self.tokens, None)
+
+    def goto_next_n_lines(self, n):
+        for _ in range(n):
+            self.goto_next_line()
 
     def strip_rst_lines(self):
-        for i, line in enumerate(self.rst_lines):
-            if RstParser.space_pattern.search(line):
-                raise Exception('{}: {} - {}: has trailing white space'.
-                                format(self.file, i + 1, repr(line)))
-            if line.find('\t') >= 0:
-                raise Exception('{}: {} - {}: can not use tab for indenting'.
-                                format(self.file, i + 1, repr(line)))
-            if line == '\n' and not self.rst_lines[i - 1]:
-                raise Exception('{}: {} - {}: do not use two continuous blank'
-                                'line'.format(self.file, i, repr(line)))
-            self.rst_lines[i] = line.rstrip()
-
-    def set_parse_area(self):
-        if ('\n'.join(self.rst_lines[0:self.start_file_line - 1]) + '\n' !=
-                Module.start_str):
-            raise Exception('{}: rst file must start with:\n{}'.
-                            format(self.file, Module.start_str))
-        end = -1
-        while not self.rst_lines[end]:
-            end -= 1
-        if self.rst_lines[end] + '\n' != Module.end_str:
-            raise Exception('{}: rst file must end with:\n{}'.
-                            format(self.file, Module.end_str))
-        # noinspection PyAttributeOutsideInit
-        self.rst_lines = self.rst_lines[6:end]
-        self.end = len(self.rst_lines)
-
-    def parse_rst_lines(self):
-        i = 6
-        cmp_offset = 0
-        while i < self.end:
-            reg = self.get_next_reg()
-            if not reg:
+        rf = open(self.file, 'r') if self.lines is None else None
+        try:
+            pre_line = None
+            for i, line in enumerate(rf or self.lines, 1):
+                line = line.rstrip('\r\n')
+                if line[-1:] in (' ', '\t'):
+                    self.report(RstError('{}: has trailing white space'.
+                                         format(repr(line)), 'whitespace',
+                                         self.file, i))
+                    line = line.rstrip()
+                if line.find('\t') >= 0:
+                    self.report(RstError('{}: can not use tab for indenting'.
+                                         format(repr(line)), 'tab',
+                                         self.file, i))
+                if not line and pre_line == '':
+                    self.report(RstError('do not use two continuous blank '
+                                         'line', 'blank-line', self.file, i))
+                pre_line = line
+                yield i, line
+        finally:
+            if rf:
+                rf.close()
+
+    def tokenize(self):
+        """Yield (file line, line, kind, match) for the parse area."""
+        lines = self.strip_rst_lines()
+        start_lines = [next(lines, (0, None))[1]
+                       for _ in RstParser.start_lines]
+        if start_lines != RstParser.start_lines:
+            self.report(RstError('rst file must start with:\n{}'.
+                                 format(Module.start_str), 'start',
+                                 self.file, 1))
+        match = RstParser.token_pattern.match
+        for i, line in lines:
+            if line == RstParser.end_line:
+                break
+            token_match = match(line) if line else None
+            yield (i, line, token_match.lastgroup if token_match else
+                   ('other' if line else 'blank'), token_match)
+        else:
+            self.report(RstError('rst file must end with:\n{}'.
+                                 format(Module.end_str), 'end', self.file))
+        for i, line in lines:
+            if line:
+                self.report(RstError('rst file must end with:\n{}'.
+                                     format(Module.end_str), 'end',
+                                     self.file, i))
                 break
-            if reg.offset < cmp_offset or reg.offset % 4:
-                raise Exception('{}> {}\n'.format(self.file, reg.full_des))
-            cmp_offset = reg.offset + 4
-            self.regs.append(reg)
 
     def get_next_reg(self):
+        name, description, offset, width = self.cur_pos_to_reg_attr()
+        reg = Register(name, description, offset, width)
+        header_lines = RstParser.header_lines
+        if not self.match_lines(header_lines[:2]):
+            self.raise_table_header_error()
+        if self.cur_line == RstParser.long_table_line:
+            reg.is_long_table = True
+            self.goto_next_line()
+        if not self.match_lines(header_lines[2:]):
+            self.raise_table_header_error()
+        reg_line = self.file_line
+        if not self.append_all_reg_field(reg):
+            return None
         try:
-            name, description, offset = self.cur_pos_to_reg_attr()
-        except IndexError:
+            reg.check_bits()
+        except RstError as e:
+            # the next register is already reached, so go on from there
+            e.file, e.line = self.file, reg_line
+            self.report(e)
             return None
-        reg = Register(name, description, offset)
-        if ('\n'.join(self.rst_lines[self.i:self.i + 8]) + '\n' ==
-                Register.header_str):
-            self.goto_next_n_lines(8)
-        elif ('\n'.join(self.rst_lines[self.i:self.i + 9]) + '\n' ==
-                Register.long_table_header_str):
-            reg.is_long_table = True
-            self.goto_next_n_lines(9)
-        else:
-            raise Exception('{}: {}> table header string error\n'.
-                            format(self.file, self.file_line))
-        self.append_all_reg_field(reg)
         return reg
 
+    def match_lines(self, lines):
+        for line in lines:
+            if self.cur_line != line:
+                return False
+            self.goto_next_line()
+        return True
+
+    def raise_table_header_error(self):
+        raise self.error('table-header', 'table header string error\n')
+
     def append_all_reg_field(self, reg):
+        """Parse the fields of reg, returns False if any of them is broken.
+
+        The bits are not checked here, a broken field would only make them
+        fail again.
+        """
         bits = []
+        broken = False
         while True:
-            bit = self.cur_line_to_reg_field()
+            try:
+                bit = self.cur_line_to_reg_field()
+            except RstError as e:
+                self.report(e)
+                broken = True
+                self.skip_to_next_field()
+                if self.cur_kind == 'bit':
+                    continue
+                break
             bits.append(bit)
             if not bit.down:
-                self.goto_next_line()
+                # text right under the table belongs to the end description
+                if not self.cur_line:
+                    self.goto_next_line()
                 reg.description_end = self.get_register_end_description()
                 break
-        reg.set_all_bits(bits)
+        if broken:
+            return False
+        reg.set_all_bits(bits, check=False)
+        return True
 
     def get_register_end_description(self):
-        result = StringIO()
-        while self.i < self.end and not self.try_cur_pos_to_reg_attr()[0]:
+        segments = []
+        while not self.at_end and not self.is_reg_start():
             if self.cur_line:
-                if not self.pre_line:
-                    result.write('\n')
-                else:
-                    result.write(' ')
-                result.write(self.cur_line)
+                segments.append(' ' if self.pre_line else '\n')
+                segments.append(self.cur_line)
             self.goto_next_line()
-        return result.getvalue().lstrip()
+        return ''.join(segments).lstrip()
 
     def cur_line_to_reg_field(self):
         bit = self.cur_line_to_reg_bit()
@@ -348,36 +855,39 @@ class RstParser(object):
                                  val_type)
         return reg_field
 
+    def cur_item_value(self):
+        return self.cur_match.group('value') if self.cur_kind == 'item' else ''
+
     def cur_line_to_reg_access(self):
-        access_match = RstParser.access_pattern.match(self.cur_line)
-        if not access_match:
-            raise Exception('{}: {}> {} can not find any access flag\n'
-                            'correct flag is \'R/W|R|W1P|W1C|W1P/R|--\'\n'.
-                            format(self.file, self.file_line,
-                                   repr(self.cur_line)))
+        access = self.cur_item_value()
+        if access not in RstParser.access_values:
+            raise self.error('access', '{} can not find any access flag\n'
+                             'correct flag is \'R/W|R|W1P|W1C|W1P/R|--\'\n'.
+                             format(repr(self.cur_line)))
         self.goto_next_line()
-        return access_match.group(1)
+        return access
 
     def cur_line_to_reg_reset(self):
-        reset_match = RstParser.reset_pattern.match(self.cur_line)
-        if not reset_match:
-            raise Exception('{}: {}> {} reset value is error\n'
-                            'correct eg: 0xA4. must be upper case\n'.
-                            format(self.file, self.i + 1, self.cur_line))
-        reset = reset_match.group(1)
+        reset = self.cur_item_value()
+        if reset != reserved_str and (
+                reset[:2] != '0x' or not reset[2:] or
+                reset[2:].strip(RstParser.hex_digits)):
+            raise self.error('reset', '{} reset value is error\n'
+                             'correct eg: 0xA4. must be upper case\n'.
+                             format(repr(self.cur_line)))
         reset = ('0x{:X}'.format(int(reset, 16)) if reset != reserved_str
                  else reset)
         self.goto_next_line()
         return reset
 
     def cur_line_to_reg_type(self):
-        type_match = RstParser.type_pattern.match(self.cur_line)
-        if not type_match:
-            raise Exception('{} {}> {} type flag incorrect\n'
-                            'correct is \'U|S|--\''.
-                            format(self.file, self.i + 1, self.cur_line))
+        val_type = self.cur_item_value()
+        if val_type not in RstParser.type_values:
+            raise self.error('type', '{} type flag incorrect\n'
+                             'correct is \'U|S|--\''.
+                             format(repr(self.cur_line)))
         self.goto_next_line()
-        return type_match.group(1)
+        return val_type
 
     def cur_pos_to_name_description(self):
         if self.description_is_reserved():
@@ -386,128 +896,742 @@ class RstParser(object):
         return self.get_description()
 
     def description_is_reserved(self):
-        if self.cur_line == RstParser.reserved_pattern:
+        if self.cur_item_value() == RstParser.reserved_value:
             return True
         else:
             return False
 
     def get_description(self):
-        des0_match = RstParser.des0_pattern.match(self.cur_line)
-        if des0_match:
-            name = des0_match.group(1)
-            description = des0_match.group(2)
+        if self.cur_kind == 'field':
+            name = self.cur_match.group('field_name')
+            segments = [self.cur_match.group('field_des')]
             self.goto_next_line()
-            while self.i < self.end:
-                des1_match = RstParser.des1_pattern.match(self.cur_line)
-                if des1_match:
-                    if not self.pre_line:
-                        description += '\n' + des1_match.group(1)
-                    else:
-                        description += ' ' + des1_match.group(1)
+            while not self.at_end:
+                if self.cur_kind == 'text':
+                    segments.append(' ' if self.pre_line else '\n')
+                    segments.append(self.cur_match.group('text_des'))
                     self.goto_next_line()
-                elif not self.cur_line:
+                elif self.cur_kind == 'blank':
                     self.goto_next_line()
                 else:
                     break
-            return name, description
+            return name, ''.join(segments)
         else:
-            raise Exception('{}: {}> {}: description format is error\n'
-                            'correct string is \'Reserved\' or '
-                            '\'**signal** description\'\n'.
-                            format(self.file, self.file_line,
-                                   repr(self.cur_line)))
+            raise self.error('description',
+                             '{}: description format is error\n'
+                             'correct string is \'Reserved\' or '
+                             '\'**signal** description\'\n'.
+                             format(repr(self.cur_line)))
 
     def cur_line_to_reg_bit(self):
-        bit_match = RstParser.bit_pattern.match(self.cur_line)
-        if bit_match:
+        if self.cur_kind == 'bit':
+            up = self.cur_match.group('up')
+            down = self.cur_match.group('down') or up
             self.goto_next_line()
-            up = bit_match.group(1)
-            down = bit_match.group(2) if bit_match.group(2) else up
             return int(up), int(down)
         else:
-            raise Exception('{}: {}> {} bit format error or bit is not end'
-                            'with 0'.format(self.file, self.file_line,
-                                            repr(self.cur_line)))
+            raise self.error('bit', '{} bit format error or bit is not end '
+                             'with 0'.format(repr(self.cur_line)))
 
     def cur_pos_to_reg_attr(self):
-        name, description, offset = self.try_cur_pos_to_reg_attr()
+        name, description, offset, width = self.try_cur_pos_to_reg_attr()
         if name:
             self.goto_next_n_lines(2)
-            return name, description, offset
+            return name, description, offset, width
         else:
-            raise Exception('{}: {}> {}can not find reg name'.
-                            format(self.file, self.file_line, self.cur_line))
+            raise self.error('reg-name', '{}: can not find reg name'.
+                             format(repr(self.cur_line)))
 
     def raise_reg_name_error(self):
-        raise Exception('{}: {}> {}: register name format error\n'
-                        'notice whitespace needed and the length of \'^\',\n'
-                        'correct is\n'
-                        'NAME (des, 0xXXXX_XXXX) des_ex\n'
-                        '^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^\n'.
-                        format(self.file, self.file_line,
-                               self.cur_line))
+        raise self.error('reg-name', '{}: register name format error\n'
+                         'notice whitespace needed and the length of \'^\','
+                         '\ncorrect is\n'
+                         'NAME (des, 0xXXXX_XXXX) des_ex\n'
+                         '^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^\n'
+                         'a register which is not 32-bit is '
+                         'NAME (des, 0xXXXX_XXXX, 64-bit)\n'.
+                         format(self.cur_line))
 
     def try_cur_pos_to_reg_attr(self):
-        i = self.i
-        name_match = RstParser.name_pattern.match(self.rst_lines[i])
-        i += 1
-        if name_match:
-            section_match = RstParser.section_pattern.match(self.rst_lines[i])
-            if (section_match and len(name_match.group(0)) <= len(
-                    section_match.group(0))):
-                name = name_match.group(1)
-                offset = name_match.group(3)
-                description = name_match.group(2), name_match.group(4)
-                return name, description, int(offset.replace('_', ''), 16)
+        next_token = self.next_token
+        next_is_section = next_token is not None and next_token[2] == 'section'
+        if self.cur_kind == 'name':
+            if next_is_section and len(self.cur_line) <= len(next_token[1]):
+                name_match = self.cur_match
+                name = name_match.group('reg_name')
+                offset = name_match.group('offset')
+                description = (name_match.group('reg_des'),
+                               name_match.group('reg_des_ex'))
+                width = int(name_match.group('width') or 32)
+                if width not in reg_widths:
+                    raise self.error('bit-width', '{}: width {} is not one '
+                                     'of 8, 16, 32 or 64-bit'.
+                                     format(self.cur_line, width))
+                return (name, description, int(offset.replace('_', ''), 16),
+                        width)
             else:
                 self.raise_reg_name_error()
-        elif RstParser.section_pattern.match(self.rst_lines[i]):
+        elif next_is_section:
             self.raise_reg_name_error()
-        return '', ['', None], 0
+        return '', ['', None], 0, 32
 
     def get_all_regs(self):
         return self.regs
 
 
-def generate_header_files(modules_dir, headers_dir):
-    modules = [name for name in os.listdir(modules_dir)
-               if os.path.isdir(os.path.join(modules_dir, name))]
+def load_manifest(headers_dir):
+    try:
+        with open(os.path.join(headers_dir, manifest_name), 'r') as mf:
+            manifest = json.load(mf)
+    except (IOError, ValueError):
+        return {}
+    return manifest.get('modules', {})
+
+
+def save_manifest(headers_dir, entries):
+    manifest = {'version': generator_version, 'modules': entries}
+    update_file(os.path.join(headers_dir, manifest_name),
+                json.dumps(manifest, indent=2, sort_keys=True) + '\n')
+
+
+def is_up_to_date(headers_dir, entry, digest, options):
+    if (not entry or entry.get('rst') != digest or
+            entry.get('version') != generator_version or
+            entry.get('options') != options):
+        return False
+    for output, output_digest in entry.get('outputs', {}).items():
+        try:
+            with open(os.path.join(headers_dir, output), 'rb') as rf:
+                if get_digest(rf.read()) != output_digest:
+                    return False
+        except IOError:
+            return False
+    return True
+
+
+class PhaseTimer(object):
+    """Record the phases of a module conversion as trace events."""
+
+    def __init__(self, module):
+        self.module = module
+        self.events = []
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        args = {'module': self.module}
+        start = time.time()
+        try:
+            yield args
+        finally:
+            self.events.append({'name': name, 'cat': 'convert', 'ph': 'X',
+                                'ts': int(start * 1e6),
+                                'dur': int((time.time() - start) * 1e6),
+                                'pid': os.getpid(), 'tid': 0, 'args': args})
+
+
+def save_profile(profile_file, events):
+    """Write events in the trace event format of chrome://tracing."""
+    with open(profile_file, 'w') as pf:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, pf,
+                  indent=1)
+
+
+def convert_module_files(timer, modules_dir, headers_dir, mod, entry,
+                         cache_dir, options):
+    log = []
+    try:
+        input_file = os.path.join(modules_dir, mod, 'registers.rst')
+        with timer.phase('read') as args:
+            with open(input_file, 'rb') as rf:
+                data = rf.read()
+            digest = get_digest(data)
+            args['bytes'], args['lines'] = len(data), data.count(b'\n')
+        if is_up_to_date(headers_dir, entry, digest, options):
+            log.append('skip {}, it is not changed'.format(input_file))
+            return log, entry, None, None
+        entry = {'rst': digest, 'version': generator_version,
+                 'options': options, 'outputs': {}}
+        with timer.phase('parse') as args:
+            rst_parser = RstParser(input_file, lines=StringIO(data.decode()),
+                                   cache_dir=cache_dir)
+            args['regs'] = len(rst_parser.get_all_regs())
+        with timer.phase('validate'):
+            isp_module = Module(mod, options.get('instances'))
+            isp_module.append_regs(rst_parser.get_all_regs())
+            entry['span'] = list(isp_module.get_span())
+        write_module_files(timer, headers_dir, input_file, isp_module, entry,
+                           log)
+    except Exception as e:
+        return log, None, e, None
+    return log, entry, None, isp_module
+
+
+def write_module_files(timer, headers_dir, input_file, isp_module, entry,
+                       log):
+    """Render the outputs of a parsed module, record them in entry."""
+    mod, options = isp_module.name, entry['options']
+    with timer.phase('render'):
+        user_header, kernel_header = StringIO(), StringIO()
+        isp_module.write_headers(user_header, kernel_header,
+                                 accessors=options.get('accessors'))
+        outputs = [('user/{}_reg.h'.format(mod), user_header.getvalue()),
+                   ('kernel/{}_reg.h'.format(mod), kernel_header.getvalue())]
+        if options.get('database'):
+            outputs.append(('db/{}_reg.json'.format(mod),
+                            json.dumps(isp_module.to_database(),
+                                       separators=(',', ':'),
+                                       sort_keys=True) + '\n'))
+    for output, content in outputs:
+        log.append('convert {} to {}'.
+                   format(input_file, os.path.join(headers_dir, output)))
+        with timer.phase('write ' + output) as args:
+            args['written'] = update_file(os.path.join(headers_dir, output),
+                                          content)
+            args['lines'] = content.count('\n')
+        entry['outputs'][output] = get_digest(content.encode())
+
+
+def convert_module(task):
+    """Convert one module, returns (log, manifest entry, error, events).
+
+    The Module itself is not returned, to keep results cheap to send back
+    from the worker processes.
+
+    The conversion runs under cProfile when the last item of task is the
+    file to dump the profile statistics to.
+    """
+    cprofile_file = task[-1]
+    timer = PhaseTimer(task[2])
+    if cprofile_file:
+        profiler = cProfile.Profile()
+        result = profiler.runcall(convert_module_files, timer, *task[:-1])
+        profiler.dump_stats(cprofile_file)
+    else:
+        result = convert_module_files(timer, *task[:-1])
+    return result[:3] + (timer.events,)
+
+
+def load_instances(modules_dir):
+    """Read the instances of the modules from instances.json.
+
+    The file maps a module to its instances, and the name of an instance
+    to its base address, given as a number or as a '0xXXXX_XXXX' string.
+    Base addresses are 32-bit, like the uint32_t tables they go in. The
+    rst file of such a module is parsed once for all its instances.
+    Returns the sorted [name, base] of the instances by module.
+    """
+    instances_file = os.path.join(modules_dir, instances_name)
+    if not os.path.exists(instances_file):
+        return {}
+    with open(instances_file, 'r') as inf:
+        try:
+            data = json.load(inf)
+        except ValueError as e:
+            raise RstError(str(e), 'instances', instances_file)
+    if not isinstance(data, dict):
+        raise RstError('instances must be an object of modules',
+                       'instances', instances_file)
+    instances = {}
+    for mod, mod_instances in data.items():
+        if not os.path.isdir(os.path.join(modules_dir, mod)):
+            raise RstError('module {} is not found'.format(mod), 'instances',
+                           instances_file)
+        if not isinstance(mod_instances, dict):
+            raise RstError('instances of {} must be an object of names and '
+                           'base addresses'.format(mod), 'instances',
+                           instances_file)
+        bases = []
+        for name, base in mod_instances.items():
+            if not re.match(r'^[A-Za-z_][A-Za-z0-9_]*$', name):
+                raise RstError('instance name {} is not a C identifier'.
+                               format(name), 'instances', instances_file)
+            try:
+                if not isinstance(base, int):
+                    base = int(base.replace('_', ''), 16)
+            except (AttributeError, ValueError):
+                raise RstError('base address {} of {} is error'.
+                               format(base, name), 'instances',
+                               instances_file)
+            if not 0 <= base <= 0xffffffff:
+                raise RstError('base address 0x{:X} of {} is not 32-bit'.
+                               format(base, name), 'instances',
+                               instances_file)
+            bases.append([name, base])
+        instances[mod] = sorted(bases, key=lambda instance: instance[1])
+    return instances
+
+
+def get_module_options(options, instances):
+    if not instances:
+        return options
+    return dict(options, instances=instances)
+
+
+def list_modules(modules_dir):
+    return sorted(name for name in os.listdir(modules_dir)
+                  if os.path.isdir(os.path.join(modules_dir, name)))
+
+
+def make_header_dirs(headers_dir, options):
     if not os.path.exists(headers_dir):
         os.makedirs(headers_dir)
     user_dir = os.path.join(headers_dir, 'user')
     kernel_dir = os.path.join(headers_dir, 'kernel')
+    db_dir = os.path.join(headers_dir, 'db')
     if not os.path.exists(user_dir):
         os.mkdir(user_dir)
     if not os.path.exists(kernel_dir):
         os.mkdir(kernel_dir)
-    for mod in modules:
-        input_file = os.path.join(modules_dir, mod, 'registers.rst')
-        user_file = os.path.join(user_dir, '{}_reg.h'.format(mod))
-        kernel_file = os.path.join(kernel_dir, '{}_reg.h'.format(mod))
-        print('convert {} to {}'.format(input_file, user_file))
-        rst_parser = RstParser(input_file)
+    if options.get('database') and not os.path.exists(db_dir):
+        os.mkdir(db_dir)
+
+
+def get_options(database=False, accessors=False):
+    """The options changing the outputs, as recorded in the manifest."""
+    return {'database': database, 'accessors': accessors}
+
+
+def generate_header_files(modules_dir, headers_dir, jobs=1, force=False,
+                          cache_dir=None, profile=None, profile_module=None,
+                          options=None):
+    """Convert every module of modules_dir.
+
+    Returns the manifest entries of the modules, by module name.
+    """
+    modules = list_modules(modules_dir)
+    options = options or get_options()
+    instances = load_instances(modules_dir)
+    make_header_dirs(headers_dir, options)
+    manifest = {} if force else load_manifest(headers_dir)
+    entries = {}
+    events = []
+    cprofile_file = (os.path.splitext(profile)[0] + '.{}.prof'.
+                     format(profile_module) if profile else None)
+    tasks = [(modules_dir, headers_dir, mod, manifest.get(mod), cache_dir,
+              get_module_options(options, instances.get(mod)),
+              cprofile_file if mod == profile_module else None)
+             for mod in modules]
+    pool = multiprocessing.Pool(jobs) if jobs > 1 and len(tasks) > 1 else None
+    try:
+        # results come back in task order, so the log and the first error
+        # reported are the same whatever the number of jobs
+        results = pool.imap(convert_module, tasks) if pool else map(
+            convert_module, tasks)
+        for mod, (log, entry, error, mod_events) in zip(modules, results):
+            events.extend(mod_events)
+            for line in log:
+                print(line)
+            if error:
+                raise error
+            entries[mod] = entry
+    finally:
+        if pool:
+            pool.terminate()
+            pool.join()
+        # modules converted before an error are kept, failed and removed
+        # modules are dropped so they are converted again next time
+        save_manifest(headers_dir, entries)
+        if profile:
+            save_profile(profile, events)
+    return entries
+
+
+def lint_module(task):
+    modules_dir, mod = task
+    input_file = os.path.join(modules_dir, mod, 'registers.rst')
+    try:
+        errors = RstParser(input_file, lint=True).errors
+    except (IOError, OSError) as e:
+        return [RstError(str(e), 'io', input_file)]
+    except UnicodeDecodeError as e:
+        return [RstError(str(e), 'encoding', input_file)]
+    return sorted(errors, key=lambda error: error.line or 0)
+
+
+def lint_rst_files(modules_dir, jobs=1):
+    """Check the rst files of all modules and print every error found.
+
+    Returns the number of errors.
+    """
+    tasks = [(modules_dir, mod) for mod in list_modules(modules_dir)]
+    pool = multiprocessing.Pool(jobs) if jobs > 1 and len(tasks) > 1 else None
+    error_num = 0
+    try:
+        results = pool.imap(lint_module, tasks) if pool else map(
+            lint_module, tasks)
+        for errors in results:
+            for error in errors:
+                print('{}:{}: {}: {}'.format(error.file, error.line or 0,
+                                             error.code,
+                                             error.message.splitlines()[0]))
+            error_num += len(errors)
+    finally:
+        if pool:
+            pool.terminate()
+            pool.join()
+    return error_num
+
+
+def get_rst_content(text):
+    """The (line number, text) of the non-blank lines of an rst file.
+
+    Runs of whitespace are collapsed, leading zeros of hex values are
+    dropped and title underlines of any length are equal, which is all
+    formatting may change in a line.
+    """
+    content = []
+    for i, line in enumerate(text.splitlines(), 1):
+        line = ' '.join(line.split())
+        if line:
+            line = underline_pattern.sub('^', line)
+            content.append((i, hex_zeros_pattern.sub(r'0x\1', line)))
+    return content
+
+
+def check_rst_content(input_file, text, formatted):
+    """Raise an RstError when formatted lost or changed a line of text.
+
+    The parser keeps the registers, not the lines, so a list or a wrapped
+    description would be joined into one line by the formatter.
+    """
+    content = get_rst_content(text)
+    formatted_content = get_rst_content(formatted)
+    for (line, original), (_, rendered) in zip(content, formatted_content):
+        if original != rendered:
+            break
+    else:
+        if len(content) == len(formatted_content):
+            return
+        line, original = (content[len(formatted_content)]
+                          if len(content) > len(formatted_content)
+                          else (None, ''))
+    raise RstError('formatting would lose or change this line, fix it by '
+                   'hand: {}'.format(repr(original)), 'format', input_file,
+                   line)
+
+
+def format_module(task):
+    modules_dir, mod, check, cache_dir = task
+    input_file = os.path.join(modules_dir, mod, 'registers.rst')
+    try:
+        with open(input_file, 'rb') as rf:
+            text = rf.read().decode()
+        rst_parser = RstParser(input_file, lines=StringIO(text),
+                               cache_dir=cache_dir)
         isp_module = Module(mod)
         isp_module.append_regs(rst_parser.get_all_regs())
-        isp_module.generate_headers(user_file)
-        print('convert {} to {}'.format(input_file, kernel_file))
-        isp_module.generate_headers(kernel_file, user_space=False)
+        rst_str = StringIO()
+        isp_module.write_rst(rst_str)
+        formatted = rst_str.getvalue()
+        if formatted == text:
+            return input_file, False, None
+        check_rst_content(input_file, text, formatted)
+    except RstError as e:
+        e.file = e.file or input_file
+        return input_file, False, e
+    except (IOError, OSError) as e:
+        return input_file, False, RstError(str(e), 'io', input_file)
+    except UnicodeDecodeError as e:
+        return input_file, False, RstError(str(e), 'encoding', input_file)
+    if not check:
+        update_file(input_file, formatted)
+    return input_file, True, None
+
 
+def format_rst_files(modules_dir, jobs=1, check=False, cache_dir=None):
+    """Rewrite the rst files of all modules in their canonical format.
 
-def merge_header_files(headers_dir):
-    with open(os.path.join(headers_dir, 'isp_reg.h'), 'w') as isp_header_file:
-        modules = [name for name in os.listdir(headers_dir)
-                   if name.endswith('.h') and name != 'isp_reg.h']
-        for mod in modules:
-            isp_header_file.write('#include "{}"\n'.format(mod))
+    Only files whose canonical rst differs are written, with check nothing
+    is written and they are only reported. Returns the number of files
+    which are changed, or need a change, and the number of errors.
+    """
+    tasks = [(modules_dir, mod, check, cache_dir)
+             for mod in list_modules(modules_dir)]
+    pool = multiprocessing.Pool(jobs) if jobs > 1 and len(tasks) > 1 else None
+    changed_num = error_num = 0
+    try:
+        results = pool.imap(format_module, tasks) if pool else map(
+            format_module, tasks)
+        for input_file, changed, error in results:
+            if error:
+                print('error: {}'.format(error))
+                error_num += 1
+            elif changed:
+                print('{} {}'.format('need format' if check else 'format',
+                                     input_file))
+                changed_num += 1
+    finally:
+        if pool:
+            pool.terminate()
+            pool.join()
+    return changed_num, error_num
+
+
+def watch_header_files(modules_dir, headers_dir, cache_dir=None,
+                       interval=0.05, options=None, address_map=False):
+    """Regenerate the headers of each module whose rst file changes.
+
+    Parsed modules are kept in memory and the modules directory is polled
+    every interval seconds, only a module whose registers.rst changed is
+    parsed again. When only the instances of a module change, its headers
+    are rendered again from the module in memory. The isp_reg.h files are
+    only merged again when the set of converted modules changes. Runs
+    until interrupted.
+    """
+    options = options or get_options()
+    make_header_dirs(headers_dir, options)
+    # every module is converted on the first scan, which fills entries
+    entries = {}
+    modules = {}
+    merged = None
+    instances, instances_key = {}, None
+    while True:
+        names = set()
+        changed = False
+        reinstance = ()
+        try:
+            stat = os.stat(os.path.join(modules_dir, instances_name))
+            key = stat.st_mtime_ns, stat.st_size
+        except OSError:
+            key = None
+        if key != instances_key:
+            instances_key = key
+            try:
+                instances = load_instances(modules_dir)
+            except RstError as e:
+                print('error: {}'.format(e))
+            reinstance = set(modules)
+        for mod in list_modules(modules_dir):
+            input_file = os.path.join(modules_dir, mod, 'registers.rst')
+            try:
+                stat = os.stat(input_file)
+            except OSError:
+                continue
+            names.add(mod)
+            key = stat.st_mtime_ns, stat.st_size
+            mod_options = get_module_options(options, instances.get(mod))
+            if mod in modules and modules[mod][0] == key:
+                isp_module = modules[mod][1]
+                if (mod not in reinstance or isp_module is None or
+                        mod not in entries or
+                        entries[mod]['options'] == mod_options):
+                    continue
+                # the rst file is not changed, only render the instances
+                isp_module.instances = instances.get(mod) or []
+                entry = dict(entries[mod], options=mod_options, outputs={})
+                log, error = [], None
+                try:
+                    write_module_files(PhaseTimer(mod), headers_dir,
+                                       input_file, isp_module, entry, log)
+                except Exception as e:
+                    error = e
+            else:
+                log, entry, error, isp_module = convert_module_files(
+                    PhaseTimer(mod), modules_dir, headers_dir, mod, None,
+                    cache_dir, mod_options)
+            for line in log:
+                print(line)
+            if error:
+                # keep the last good module until the rst file is fixed
+                print('error: {}'.format(error))
+                isp_module = modules[mod][1] if mod in modules else None
+            else:
+                entries[mod] = entry
+                changed = True
+            modules[mod] = key, isp_module
+        for mod in set(modules) - names:
+            del modules[mod]
+            for output in entries.pop(mod, {}).get('outputs', {}):
+                print('remove {}'.format(os.path.join(headers_dir, output)))
+                try:
+                    os.remove(os.path.join(headers_dir, output))
+                except FileNotFoundError:
+                    pass
+            changed = True
+        if changed:
+            save_manifest(headers_dir, entries)
+            if options.get('database'):
+                merge_database_files(os.path.join(headers_dir, 'db'),
+                                     entries)
+            if address_map:
+                write_address_map(headers_dir, entries)
+        # only converted modules are merged, a module failing on the
+        # first scan is added once it is fixed
+        if set(entries) != merged:
+            merge_header_files(os.path.join(headers_dir, 'user'), entries)
+            merge_header_files(os.path.join(headers_dir, 'kernel'), entries)
+            merged = set(entries)
+        time.sleep(interval)
+
+
+def list_outputs(output_dir, suffix):
+    """The modules with a <module><suffix> file in output_dir."""
+    return sorted(name[:-len(suffix)] for name in os.listdir(output_dir)
+                  if name.endswith(suffix) and name != 'isp' + suffix)
+
+
+def merge_header_files(headers_dir, modules=None):
+    """Write isp_reg.h including the headers of modules in sorted order.
+
+    Without modules, the headers found in headers_dir are included.
+    """
+    if modules is None:
+        modules = list_outputs(headers_dir, '_reg.h')
+    isp_header_file = StringIO()
+    for mod in sorted(modules):
+        isp_header_file.write('#include "{}_reg.h"\n'.format(mod))
+    update_file(os.path.join(headers_dir, 'isp_reg.h'),
+                isp_header_file.getvalue())
+
+
+def write_address_map(headers_dir, entries):
+    """Write isp_reg_map.h with the address range of every instance.
+
+    Only the instances listed in instances.json have a base address, a
+    module without instances only gets its _REG_SIZE and is left out of
+    the isp_reg_map table. The table is sorted by base address, so an
+    address can be decoded to its instance with a binary search.
+    """
+    spans = []
+    sizes = []
+    for mod, entry in sorted(entries.items()):
+        base, size = entry['span']
+        mod_instances = entry['options'].get('instances')
+        if not mod_instances:
+            sizes.append((mod, size))
+        for instance, instance_base in mod_instances or ():
+            spans.append((instance_base + base, instance, size))
+    spans.sort()
+    map_file = StringIO()
+    map_file.write('#ifndef _ISP_REG_MAP_H\n#define _ISP_REG_MAP_H\n\n')
+    map_file.write('#include <stdint.h>\n\n')
+    for mod, size in sizes:
+        map_file.write('#define {}_REG_SIZE 0x{:08X}\n'.
+                       format(mod.upper(), size))
+    for base, mod, size in spans:
+        map_file.write('#define {}_REG_BASE 0x{:08X}\n'.
+                       format(mod.upper(), base))
+        map_file.write('#define {}_REG_SIZE 0x{:08X}\n'.
+                       format(mod.upper(), size))
+    map_file.write('\nstruct isp_reg_map {\n'
+                   '\tconst char *name;\n'
+                   '\tuint32_t base;\n'
+                   '\tuint32_t size;\n'
+                   '};\n\n'
+                   'static const struct isp_reg_map isp_reg_map[] = {\n')
+    for base, mod, size in spans:
+        map_file.write('\t{{ "{}", {}_REG_BASE, {}_REG_SIZE }},\n'.
+                       format(mod, mod.upper(), mod.upper()))
+    map_file.write('};\n\n#endif /* _ISP_REG_MAP_H */\n')
+    update_file(os.path.join(headers_dir, 'isp_reg_map.h'),
+                map_file.getvalue())
+
+
+def merge_database_files(db_dir, modules=None):
+    """Merge the module databases into isp_reg.json.
+
+    by_name maps a register name to its module and its index there.
+    Without modules, the databases found in db_dir are merged.
+    """
+    if modules is None:
+        modules = list_outputs(db_dir, '_reg.json')
+    databases, by_name = {}, {}
+    for mod in sorted(modules):
+        with open(os.path.join(db_dir, mod + '_reg.json'), 'r') as df:
+            database = json.load(df)
+        databases[mod] = database
+        for reg_name, i in database['by_name'].items():
+            by_name[reg_name] = [mod, i]
+    update_file(os.path.join(db_dir, 'isp_reg.json'),
+                json.dumps({'version': generator_version,
+                            'modules': databases,
+                            'by_name': by_name}, separators=(',', ':'),
+                           sort_keys=True) + '\n')
 
 
 if __name__ == '__main__':
-    if len(sys.argv) != 3:
-        print('Usage: {} modules_dir headers_dir'.format(sys.argv[0]))
-        exit(1)
+    arg_parser = argparse.ArgumentParser(
+        description='convert rst register files to C header files')
+    arg_parser.add_argument('modules_dir')
+    arg_parser.add_argument('headers_dir', nargs='?')
+    arg_parser.add_argument('-j', '--jobs', type=int, default=1,
+                            help='number of modules converted in parallel')
+    arg_parser.add_argument('-f', '--force', action='store_true',
+                            help='convert all modules, even unchanged ones')
+    arg_parser.add_argument('--cache-dir',
+                            help='directory caching parsed rst files')
+    arg_parser.add_argument('--accessors', action='store_true',
+                            help='also write field _SHIFT/_MASK macros, '
+                                 'register _RESET values and reset tables')
+    arg_parser.add_argument('--database', action='store_true',
+                            help='also write a JSON register database of '
+                                 'every module and of the whole chip')
+    arg_parser.add_argument('--address-map', action='store_true',
+                            help='also write isp_reg_map.h with the address '
+                                 'range of every instance in instances.json')
+    arg_parser.add_argument('-l', '--lint', action='store_true',
+                            help='only check the rst files, report every '
+                                 'error instead of stopping at the first')
+    arg_parser.add_argument('--format', action='store_true',
+                            help='only rewrite the rst files which are not '
+                                 'in the canonical format')
+    arg_parser.add_argument('--check', action='store_true',
+                            help='with --format, only report the rst files '
+                                 'which are not formatted')
+    arg_parser.add_argument('-w', '--watch', action='store_true',
+                            help='keep running and convert every module '
+                                 'whose rst file changes')
+    arg_parser.add_argument('--profile', metavar='FILE',
+                            help='write the time of every conversion phase '
+                                 'to FILE as trace events')
+    arg_parser.add_argument('--profile-module', metavar='MODULE',
+                            help='also run cProfile on the conversion of '
+                                 'MODULE, stats go next to the --profile '
+                                 'FILE')
+    args = arg_parser.parse_args()
+    if args.jobs < 1:
+        arg_parser.error('--jobs must be at least 1')
+    if args.profile_module and not args.profile:
+        arg_parser.error('--profile-module needs --profile')
+    if args.lint:
+        error_num = lint_rst_files(args.modules_dir, jobs=args.jobs)
+        print('{} error(s) found'.format(error_num))
+        exit(1 if error_num else 0)
+    if args.check and not args.format:
+        arg_parser.error('--check needs --format')
+    if args.format:
+        changed_num, error_num = format_rst_files(
+            args.modules_dir, jobs=args.jobs, check=args.check,
+            cache_dir=args.cache_dir)
+        print('{} file(s) {}, {} error(s) found'.format(
+            changed_num, 'need format' if args.check else 'formatted',
+            error_num))
+        exit(1 if error_num or (args.check and changed_num) else 0)
+    if not args.headers_dir:
+        arg_parser.error('headers_dir is needed to convert rst files')
+    if args.watch and args.profile:
+        arg_parser.error('--profile can not be used with --watch')
+    options = get_options(database=args.database, accessors=args.accessors)
     print('=' * 80)
+    if args.watch:
+        print('Watch rst files in {}, press Ctrl-C to stop'.
+              format(args.modules_dir))
+        try:
+            watch_header_files(args.modules_dir, args.headers_dir,
+                               cache_dir=args.cache_dir, options=options,
+                               address_map=args.address_map)
+        except KeyboardInterrupt:
+            print('=' * 80)
+        exit(0)
     print('Begin convert rst files to C header files')
-    generate_header_files(*sys.argv[1:])
-    merge_header_files(os.path.join(sys.argv[2], 'user'))
-    merge_header_files(os.path.join(sys.argv[2], 'kernel'))
+    entries = generate_header_files(
+        args.modules_dir, args.headers_dir, jobs=args.jobs, force=args.force,
+        cache_dir=args.cache_dir, profile=args.profile,
+        profile_module=args.profile_module, options=options)
+    merge_header_files(os.path.join(args.headers_dir, 'user'), entries)
+    merge_header_files(os.path.join(args.headers_dir, 'kernel'), entries)
+    if args.database:
+        merge_database_files(os.path.join(args.headers_dir, 'db'), entries)
+    if args.address_map:
+        write_address_map(args.headers_dir, entries)
     print('=' * 80)
@@ -0,0 +1,164 @@
+import argparse
+import os
+import shutil
+import tempfile
+import time
+import tracemalloc
+from io import StringIO
+
+from rst2header import Module, Register, RegField, RstParser, reserved_str
+
+words = ('enable clock gate frame line pixel buffer status interrupt mask '
+         'threshold counter select mode value channel').split()
+
+
+def get_description(seed, description_words):
+    """Build a description of description_words words, ten per paragraph."""
+    des = [words[(seed + i) % len(words)] for i in range(description_words)]
+    return '\n'.join(' '.join(des[i:i + 10]) for i in range(0, len(des), 10))
+
+
+def get_reg_fields(reg_index, fields, description_words):
+    fields = max(1, min(fields, 32))
+    width, extra = divmod(32, fields)
+    reg_fields = []
+    down = 0
+    for i in range(fields):
+        up = down + width - 1 + (1 if i < extra else 0)
+        if i % 4 == 3:
+            reg_fields.append(RegField((up, down), reserved_str, 'Reserved',
+                                       reserved_str, reserved_str,
+                                       reserved_str))
+        else:
+            reg_fields.append(RegField(
+                (up, down), 'field{}'.format(i),
+                get_description(reg_index + i, description_words),
+                ('R/W', 'R', 'W1C')[i % 3],
+                '0x{:X}'.format(i % (1 << (up - down + 1))), 'U'))
+        down = up + 1
+    return reg_fields
+
+
+def generate_module(name, regs, fields, description_words, long_table):
+    module = Module(name)
+    reg_list = []
+    for i in range(regs):
+        reg = Register('{}_REG{}'.format(name.upper(), i),
+                       ('register {}'.format(i), None), i * 4)
+        reg.is_long_table = long_table
+        reg.set_all_bits(get_reg_fields(i, fields, description_words))
+        if i % 2:
+            reg.description_end = get_description(i, description_words)
+        reg_list.append(reg)
+    module.append_regs(reg_list)
+    return module
+
+
+def generate_rst_files(modules_dir, modules, regs, fields, description_words,
+                       long_table):
+    """Write modules_dir/<module>/registers.rst files, return their paths."""
+    rst_files = []
+    for i in range(modules):
+        name = 'mod{}'.format(i)
+        module = generate_module(name, regs, fields, description_words,
+                                 long_table)
+        os.makedirs(os.path.join(modules_dir, name), exist_ok=True)
+        rst_file = os.path.join(modules_dir, name, 'registers.rst')
+        with open(rst_file, 'w') as rf:
+            rf.write(str(module))
+        rst_files.append(rst_file)
+    return rst_files
+
+
+def parse(rst_files):
+    return [(os.path.basename(os.path.dirname(rst_file)),
+             RstParser(rst_file).get_all_regs()) for rst_file in rst_files]
+
+
+def validate(parsed):
+    modules = []
+    for name, regs in parsed:
+        for reg in regs:
+            reg.invalidate_layout()
+            reg.check_bits()
+        module = Module(name)
+        module.append_regs(regs)
+        modules.append(module)
+    return modules
+
+
+def render_rst(modules):
+    return sum(len(str(module)) for module in modules)
+
+
+def emit_headers(modules):
+    size = 0
+    for module in modules:
+        user_header, kernel_header = StringIO(), StringIO()
+        module.write_headers(user_header, kernel_header)
+        size += len(user_header.getvalue()) + len(kernel_header.getvalue())
+    return size
+
+
+def run_phase(func, arg, repeat):
+    """Return the result, the best wall time and the peak memory of func."""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(arg)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    tracemalloc.start()
+    func(arg)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, best, peak
+
+
+def run_benchmark(modules_dir, args):
+    rst_files = generate_rst_files(modules_dir, args.modules, args.regs,
+                                   args.fields, args.description_words,
+                                   args.long_table)
+    rst_bytes = sum(os.path.getsize(rst_file) for rst_file in rst_files)
+    reg_num = args.modules * args.regs
+    print('{} modules, {} registers, {:.2f} MB of rst'.
+          format(args.modules, reg_num, rst_bytes / 1e6))
+    print('{:<10} {:>10} {:>14} {:>12} {:>12}'.
+          format('phase', 'time (s)', 'regs/s', 'MB/s', 'peak (MB)'))
+
+    def report(phase, size, elapsed, peak):
+        print('{:<10} {:>10.4f} {:>14.0f} {:>12.2f} {:>12.2f}'.
+              format(phase, elapsed, reg_num / elapsed,
+                     size / elapsed / 1e6, peak / 1e6))
+
+    parsed, elapsed, peak = run_phase(parse, rst_files, args.repeat)
+    report('parse', rst_bytes, elapsed, peak)
+    modules, elapsed, peak = run_phase(validate, parsed, args.repeat)
+    report('validate', rst_bytes, elapsed, peak)
+    size, elapsed, peak = run_phase(render_rst, modules, args.repeat)
+    report('rst', size, elapsed, peak)
+    size, elapsed, peak = run_phase(emit_headers, modules, args.repeat)
+    report('headers', size, elapsed, peak)
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(
+        description='benchmark rst2header on synthetic register files')
+    arg_parser.add_argument('--modules', type=int, default=10)
+    arg_parser.add_argument('--regs', type=int, default=200,
+                            help='registers per module')
+    arg_parser.add_argument('--fields', type=int, default=8,
+                            help='fields per register')
+    arg_parser.add_argument('--description-words', type=int, default=20)
+    arg_parser.add_argument('--long-table', action='store_true')
+    arg_parser.add_argument('--repeat', type=int, default=3)
+    arg_parser.add_argument('--dir', help='keep the generated rst files here')
+    args = arg_parser.parse_args()
+    if args.dir:
+        run_benchmark(args.dir, args)
+    else:
+        temp_dir = tempfile.mkdtemp(prefix='rst2header_bench_')
+        try:
+            run_benchmark(temp_dir, args)
+        finally:
+            shutil.rmtree(temp_dir)
@@ -0,0 +1,78 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from rst2header import (Module, Register, RegField, RstParser,  # noqa: E402
+                        format_module)
+
+
+def write_module(modules_dir, end_description=''):
+    module = Module('mod')
+    reg = Register('MOD_CTRL', ('control', None), 0)
+    reg.set_all_bits([RegField((31, 1), '--', 'Reserved', '--', '--', '--'),
+                      RegField((0, 0), 'en', 'enable', 'R/W', '0x1', 'U')])
+    reg.description_end = end_description
+    module.append_regs([reg])
+    os.makedirs(os.path.join(str(modules_dir), 'mod'))
+    rst_file = os.path.join(str(modules_dir), 'mod', 'registers.rst')
+    with open(rst_file, 'w') as rf:
+        rf.write(str(module))
+    return rst_file
+
+
+def edit(rst_file, old, new):
+    with open(rst_file) as rf:
+        text = rf.read()
+    assert old in text
+    with open(rst_file, 'w') as rf:
+        rf.write(text.replace(old, new))
+    return text.replace(old, new)
+
+
+def test_canonical_file_is_not_rewritten(tmp_path):
+    rst_file = write_module(tmp_path, 'Some notes.')
+    assert format_module((str(tmp_path), 'mod', False, None)) == (
+        rst_file, False, None)
+
+
+def test_text_right_under_table_is_kept(tmp_path):
+    rst_file = write_module(tmp_path)
+    edit(rst_file, '     - U\n\n', '     - U\nNotes: keep me\n\n')
+    _, changed, error = format_module((str(tmp_path), 'mod', False, None))
+    assert changed and error is None
+    regs = RstParser(rst_file).get_all_regs()
+    assert regs[0].description_end == 'Notes: keep me'
+
+
+def test_list_is_not_joined(tmp_path):
+    rst_file = write_module(tmp_path, 'Notes:')
+    text = edit(rst_file, 'Notes:\n', 'Notes:\n\n- item one\n- item two\n')
+    _, changed, error = format_module((str(tmp_path), 'mod', False, None))
+    assert not changed and error.code == 'format'
+    with open(rst_file) as rf:
+        assert rf.read() == text
+
+
+def test_wrapped_description_is_not_joined(tmp_path):
+    rst_file = write_module(tmp_path)
+    text = edit(rst_file, '**en** enable\n',
+                '**en** enable\n       the module\n')
+    _, changed, error = format_module((str(tmp_path), 'mod', True, None))
+    assert not changed and error.code == 'format'
+    _, changed, error = format_module((str(tmp_path), 'mod', False, None))
+    assert not changed and error.code == 'format'
+    with open(rst_file) as rf:
+        assert rf.read() == text
+
+
+def test_long_underline_is_formatted(tmp_path):
+    rst_file = write_module(tmp_path)
+    with open(rst_file) as rf:
+        canonical = rf.read()
+    edit(rst_file, '^\n', '^^^^^\n')
+    _, changed, error = format_module((str(tmp_path), 'mod', False, None))
+    assert changed and error is None
+    with open(rst_file) as rf:
+        assert rf.read() == canonical
@@ -0,0 +1,94 @@
+import os
+import shutil
+import subprocess
+import sys
+from io import StringIO
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from rst2header import (Module, Register, RegField, RstError,  # noqa: E402
+                        RstParser)
+
+
+def get_reg_fields(width):
+    # the 64-bit register has a field wider than an int
+    up = 39 if width == 64 else width - 1
+    reg_fields = [RegField((up, 1), 'value', 'value', 'R/W', '0x0', 'U'),
+                  RegField((0, 0), 'en', 'enable', 'R/W', '0x1', 'U')]
+    if up != width - 1:
+        reg_fields.append(RegField((width - 1, up + 1), '--', 'Reserved',
+                                   '--', '--', '--'))
+    return reg_fields
+
+
+def get_mixed_module():
+    module = Module('wide')
+    regs = []
+    for name, offset, width in [('WIDE_CTRL', 0x0, 8), ('WIDE_MODE', 0x1, 8),
+                                ('WIDE_HALF', 0x2, 16),
+                                ('WIDE_ADDR', 0x8, 64),
+                                ('WIDE_STAT', 0x14, 32)]:
+        reg = Register(name, ('test', None), offset, width)
+        reg.set_all_bits(get_reg_fields(width))
+        regs.append(reg)
+    module.append_regs(regs)
+    return module
+
+
+@pytest.mark.skipif(not shutil.which('gcc'), reason='needs gcc')
+def test_mixed_width_struct_compiles(tmp_path):
+    module = get_mixed_module()
+    module.instances = [['wide0', 0x10000], ['wide1', 0x20000]]
+    user_header = StringIO()
+    module.write_headers(user_header, accessors=True)
+    (tmp_path / 'wide_reg.h').write_text(user_header.getvalue())
+    c_file = tmp_path / 'wide.c'
+    # the header is included twice to check its guard
+    c_file.write_text(
+        '#include <stddef.h>\n'
+        '#include "wide_reg.h"\n'
+        '#include "wide_reg.h"\n'
+        '_Static_assert(sizeof(((struct wide_reg *)0)->ctrl_bit) == 1, "");\n'
+        '_Static_assert(sizeof(((struct wide_reg *)0)->half_bit) == 2, "");\n'
+        '_Static_assert(sizeof(((struct wide_reg *)0)->addr_bit) == 8, "");\n'
+        '_Static_assert(offsetof(struct wide_reg, mode) == 0x1, "");\n'
+        '_Static_assert(offsetof(struct wide_reg, half) == 0x2, "");\n'
+        '_Static_assert(offsetof(struct wide_reg, addr) == 0x8, "");\n'
+        '_Static_assert(offsetof(struct wide_reg, stat) == 0x14, "");\n'
+        '_Static_assert(sizeof(struct wide_reg) == 0x18, "");\n'
+        '_Static_assert(WIDE_INSTANCE_NUM == 2, "");\n'
+        'unsigned long long get_reset(void)\n'
+        '{\n'
+        '\treturn wide_reg_reset.addr + wide_reg_bases[1];\n'
+        '}\n')
+    subprocess.check_call(['gcc', '-std=c11', '-Wall', '-Werror', '-c',
+                           str(c_file), '-o', str(tmp_path / 'wide.o')])
+
+
+def test_mixed_width_has_no_kernel_reset_table():
+    module = get_mixed_module()
+    user_header, kernel_header = StringIO(), StringIO()
+    module.write_headers(user_header, kernel_header, accessors=True)
+    assert 'wide_reg_reset[]' not in kernel_header.getvalue()
+    assert 'wide_reg_reset = {' in user_header.getvalue()
+    assert '#define WIDE_ADDR_VALUE_MASK 0x000000FFFFFFFFFEULL' in (
+        kernel_header.getvalue())
+
+
+def test_width_comes_from_the_title(tmp_path):
+    module = get_mixed_module()
+    rst_file = tmp_path / 'registers.rst'
+    rst_file.write_text(str(module))
+    regs = RstParser(str(rst_file)).get_all_regs()
+    assert [reg.width for reg in regs] == [8, 8, 16, 64, 32]
+    assert str(regs[3]).startswith('WIDE_ADDR (test, 0x0000_0008, 64-bit)\n')
+
+
+def test_missing_top_field_is_an_error():
+    reg = Register('M_STAT', ('status', None), 0)
+    with pytest.raises(RstError) as e:
+        reg.set_all_bits(get_reg_fields(8))
+    assert e.value.code == 'bit-width'